@@ -5,32 +5,528 @@
 解决 Dify 插件在无活跃会话时报错的问题
 增加基于历史消息队列的更人性化相关性判断逻辑
 @消息和 Bot 消息加入历史消息队列
+短时间窗口内的多条相关性判断合并为一次 SLM 调用
 """
 
 import asyncio
+import functools
 import json
+import logging
+import mmap
+import os
 import re
-from collections import deque
-from typing import Dict, List, Tuple
+import time
+from collections import defaultdict, deque
+from typing import Callable, DefaultDict, Dict, FrozenSet, List, Optional, Sequence, Set, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 from astrbot.api.message_components import Plain
 from astrbot.api import logger
 from astrbot.api.event import filter, AstrMessageEvent
 from astrbot.api.star import Context, Star, register
+from astrbot.core.db.po import Conversation
 from astrbot.core.config.astrbot_config import AstrBotConfig
 
-MESSAGE_PREFIX_PATTERN = re.compile(r"^\[.*?\/.*?\]:\s*")
+try:
+    # 旧版本 AstrBot 未提供 StarTools，此时无法获取插件数据目录，不持久化历史消息
+    from astrbot.api.star import StarTools
+except ImportError:
+    StarTools = None
+
+# 前缀形如 "[发送者/时间]: "，方括号内不含 "]"；使用 match 锚定开头，ASCII 模式避免 Unicode 字符类判断
+MESSAGE_PREFIX_REGEX = r"\[[^/\]]*?/[^\]]*?\]:\s*"
+try:
+    # 安装了 google-re2 时使用线性时间、无回溯的 RE2 引擎；RE2 的 \s 本身只匹配 ASCII 空白
+    import re2
+
+    MESSAGE_PREFIX_PATTERN = re2.compile(MESSAGE_PREFIX_REGEX)
+except ImportError:
+    MESSAGE_PREFIX_PATTERN = re.compile(MESSAGE_PREFIX_REGEX, re.ASCII)
+# 无需 SLM 判断即可视为无关的消息：纯标点/表情/空白、单个字符重复刷屏、只有链接
+OBVIOUSLY_IRRELEVANT_PATTERN = re.compile(r"[\s\W_]*|(.)\1{3,}|https?://\S+")
+CQ_CODE_PATTERN = re.compile(r"\[CQ:[^\]]*\]")
+# 在开头这么多个字符内手动解析前缀，更长的前缀交给正则处理
+MESSAGE_PREFIX_SCAN_LIMIT = 64
+_ASCII_WHITESPACE = " \t\n\r\f\v"
 MESSAGE_HISTORY_LENGTH = 5
+_make_history_deque = functools.partial(deque, maxlen=MESSAGE_HISTORY_LENGTH)
+# 区分 "尚未查找供应商" 与 "已查找但供应商不存在 (None)"
+_UNSET = object()
+# 构建 SLM Prompt 时单条消息与全部历史消息的最大字符数
+SLM_PROMPT_MESSAGE_MAX_CHARS = 200
+SLM_PROMPT_HISTORY_MAX_CHARS = 1024
+SLM_PROMPT_HEADER = "Chat History:"
+SLM_PROMPT_EMPTY_HISTORY = ("None (This is the start of a new potential conversation thread).",)
+_format_slm_prompt_latest = "\nLatest Message: %s%s".__mod__
+# 历史消息序号前缀表，构建 Prompt 时直接拼接，无需逐条格式化序号
+_HISTORY_INDEX_PREFIXES = tuple(f"{i}. " for i in range(1, MESSAGE_HISTORY_LENGTH + 1))
+DEFAULT_SEMANTIC_CACHE_MODEL = "paraphrase-multilingual-MiniLM-L12-v2"
+DEFAULT_SEMANTIC_CACHE_THRESHOLD = 0.92
+# 每个群组最多缓存的判断结果条数
+SEMANTIC_CACHE_CAPACITY = 512
+PLUGIN_NAME = "astrbot_plugin_smart_listener"
+HISTORY_LOG_FILENAME = "history.log"
+# 历史日志中每条记录前的长度前缀字节数 (小端序)
+HISTORY_LOG_LENGTH_BYTES = 4
+# 运行期间日志中的记录数超过 (白名单群组数 * 历史队列长度) 的该倍数时重写日志，丢弃已移出队列的记录
+HISTORY_LOG_COMPACT_FACTOR = 16
+# 同一类型的异常在该时间窗口 (秒) 内只记录一次完整堆栈
+ERROR_TRACEBACK_INTERVAL = 60
+# 未找到 SLM 供应商时，至少间隔该时间 (秒) 才重新查找
+PROVIDER_RETRY_INTERVAL = 60
+# 默认不合并，需要时通过 relevance_batch_size 开启
+DEFAULT_BATCH_SIZE = 1
+DEFAULT_BATCH_MAX_WAIT_MS = 30
+# merge: 合并为一个批量 Prompt 调用一次 SLM；concurrent: 每条消息单独调用 SLM，同一批次内并发发出
+BATCH_MODE_MERGE = "merge"
+BATCH_MODE_CONCURRENT = "concurrent"
+# merge 模式使用独立的系统提示词：用户提示词只作为判断标准引用，其中要求单独回复 yes/no 的格式说明不再生效
+BATCH_SYSTEM_PROMPT = (
+    "You are an assistant that analyzes several independent chat snippets at once. Each numbered item contains "
+    "a chat history followed by its latest message. For each item, decide whether its LAST message is relevant "
+    "to the character '{character}', using the relevance criteria below. Ignore any answer-format instructions "
+    "inside the criteria.\n\nRelevance criteria:\n{criteria}\n\n"
+    "Reply ONLY with a JSON array containing one 'yes' or 'no' string per item, in item order."
+)
+BATCH_PROMPT_SUFFIX = (
+    "Judge each item above independently. Reply ONLY with a JSON array of {count} strings, "
+    "each being 'yes' or 'no', in item order (e.g. [\"yes\", \"no\"])."
+)
+
+
+def _strip_prefix(text: str) -> str:
+    """去除消息开头形如 "[发送者/时间]: " 的前缀，不以 "[" 开头的消息无需经过正则"""
+    if not text or text[0] != "[":
+        return text
+
+    # 方括号内不允许出现 "]"，因此第一个 "]" 必然是前缀的结尾，其后须紧跟 ":"，且括号内须包含 "/"
+    end = text.find("]", 1, MESSAGE_PREFIX_SCAN_LIMIT)
+    if end != -1:
+        if text.startswith(":", end + 1) and "/" in text[1:end]:
+            return text[end + 2 :].lstrip(_ASCII_WHITESPACE)
+        return text
+    if len(text) <= MESSAGE_PREFIX_SCAN_LIMIT:
+        return text
+
+    match = MESSAGE_PREFIX_PATTERN.match(text)
+    return text[match.end() :] if match else text
+
+
+def _is_obviously_irrelevant(text: str) -> bool:
+    if len(text) < 2 or OBVIOUSLY_IRRELEVANT_PATTERN.fullmatch(text):
+        return True
+    # 只包含 CQ 码 (图片、表情等) 的消息
+    return "[CQ:" in text and not CQ_CODE_PATTERN.sub("", text).strip()
+
+
+def _truncate_message(text: str) -> str:
+    if len(text) <= SLM_PROMPT_MESSAGE_MAX_CHARS:
+        return text
+    return text[:SLM_PROMPT_MESSAGE_MAX_CHARS] + "…"
+
+
+def _discard_task(task: asyncio.Task):
+    """取消不再需要的任务；若任务已结束则取走其异常，避免 "exception was never retrieved" 警告"""
+    if not task.done():
+        task.cancel()
+    elif not task.cancelled():
+        task.exception()
+
+
+class _HistoryLog:
+    """历史消息的追加写日志，插件重载后用于恢复各群组的历史消息队列
+
+    每条记录为 4 字节长度前缀加上 JSON 编码的 [group_id, sender, message_text]。
+    """
+
+    __slots__ = ("_path", "_fd", "_history", "_record_count", "_compact_threshold")
+
+    def __init__(self, path: str):
+        self._path = path
+        self._fd: Optional[int] = None
+        self._history: DefaultDict[str, deque] = defaultdict(_make_history_deque)
+        self._record_count = 0
+        self._compact_threshold = 0
+
+    def load(self, group_whitelist: FrozenSet[str]) -> DefaultDict[str, deque]:
+        history: DefaultDict[str, deque] = defaultdict(_make_history_deque)
+        if os.path.exists(self._path) and os.path.getsize(self._path) > 0:
+            with open(self._path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                offset, size = 0, len(data)
+                while offset + HISTORY_LOG_LENGTH_BYTES <= size:
+                    length = int.from_bytes(data[offset : offset + HISTORY_LOG_LENGTH_BYTES], "little")
+                    start = offset + HISTORY_LOG_LENGTH_BYTES
+                    if start + length > size:
+                        # 上次写入时被中断，丢弃不完整的末尾记录
+                        break
+                    try:
+                        group_id, sender, message_text = json.loads(data[start : start + length])
+                        if not isinstance(group_id, str):
+                            raise TypeError(f"group_id 应为字符串，实际为 {type(group_id).__name__}")
+                        if group_id in group_whitelist:
+                            history[group_id].append((sender, message_text))
+                    except (ValueError, TypeError):
+                        logger.warning(f"历史消息日志 {self._path} 中存在损坏的记录，已停止读取后续内容。")
+                        break
+                    offset = start + length
+
+        # 返回的历史队列即插件使用的队列，之后压缩日志时直接以其内容重写
+        self._history = history
+        self._compact_threshold = max(1, len(group_whitelist)) * MESSAGE_HISTORY_LENGTH * HISTORY_LOG_COMPACT_FACTOR
+        self.compact()
+        return history
+
+    def append(self, group_id: str, message: Tuple[str, str]):
+        if self._fd is None:
+            return
+        os.write(self._fd, self._encode(group_id, *message))
+        self._record_count += 1
+        if self._record_count > self._compact_threshold:
+            self.compact()
+
+    def compact(self):
+        """只保留各群组队列中仍有效的记录重写日志，之后以追加模式重新打开"""
+        tmp_path = self._path + ".tmp"
+        record_count = 0
+        with open(tmp_path, "wb") as f:
+            for group_id, messages in self._history.items():
+                for sender, message_text in messages:
+                    f.write(self._encode(group_id, sender, message_text))
+                    record_count += 1
+        os.replace(tmp_path, self._path)
+
+        self.close()
+        self._fd = os.open(self._path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        self._record_count = record_count
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    @staticmethod
+    def _encode(group_id: str, sender: str, message_text: str) -> bytes:
+        record = json.dumps([group_id, sender, message_text], ensure_ascii=False).encode("utf-8")
+        return len(record).to_bytes(HISTORY_LOG_LENGTH_BYTES, "little") + record
+
+
+class _VerdictRing:
+    """单个群组的判断结果缓存，句向量保存在定长矩阵中，写满后覆盖最早的条目"""
+
+    __slots__ = ("vectors", "verdicts", "size", "next_index")
+
+    def __init__(self, dimension: int, capacity: int):
+        self.vectors = np.zeros((capacity, dimension), dtype=np.float32)
+        self.verdicts: List[str] = [""] * capacity
+        self.size = 0
+        self.next_index = 0
+
+
+class _VerdictCache:
+    """按最新消息的句向量相似度复用之前判断为无关的结果，减少重复的 SLM 调用"""
+
+    __slots__ = ("_model_name", "_threshold", "_capacity", "_model", "_model_lock", "_rings")
+
+    def __init__(self, model_name: str, threshold: float, capacity: int = SEMANTIC_CACHE_CAPACITY):
+        self._model_name = model_name
+        self._threshold = threshold
+        self._capacity = capacity
+        self._model = _UNSET
+        self._model_lock = asyncio.Lock()
+        self._rings: Dict[str, _VerdictRing] = {}
+
+    async def embed(self, text: str):
+        model = await self._get_model()
+        if model is None:
+            return None
+        return await asyncio.to_thread(model.encode, text, normalize_embeddings=True)
+
+    def lookup(self, group_id: str, embedding) -> Optional[str]:
+        ring = self._rings.get(group_id)
+        if not ring or not ring.size:
+            return None
+
+        # 句向量已归一化，点积即为余弦相似度
+        similarities = ring.vectors[: ring.size] @ embedding
+        best = int(similarities.argmax())
+        if similarities[best] < self._threshold:
+            return None
+        return ring.verdicts[best]
+
+    def store(self, group_id: str, embedding, verdict: str):
+        ring = self._rings.get(group_id)
+        if ring is None:
+            ring = self._rings[group_id] = _VerdictRing(embedding.shape[0], self._capacity)
+
+        ring.vectors[ring.next_index] = embedding
+        ring.verdicts[ring.next_index] = verdict
+        ring.next_index = (ring.next_index + 1) % self._capacity
+        ring.size = min(ring.size + 1, self._capacity)
+
+    def clear(self):
+        self._rings.clear()
+
+    async def _get_model(self):
+        if self._model is not _UNSET:
+            return self._model
+
+        async with self._model_lock:
+            if self._model is _UNSET:
+                self._model = await asyncio.to_thread(self._load_model)
+        return self._model
+
+    def _load_model(self):
+        if np is None:
+            logger.warning("未安装 numpy，语义缓存功能不可用。")
+            return None
+
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            logger.warning("未安装 sentence-transformers，语义缓存功能不可用。")
+            return None
+
+        try:
+            model = SentenceTransformer(self._model_name)
+        except Exception as e:
+            logger.warning(f"加载语义缓存模型 '{self._model_name}' 失败，语义缓存功能不可用: {str(e)}")
+            return None
+
+        logger.info(f"语义缓存模型 '{self._model_name}' 加载完成。")
+        return model
+
+
+class _BatcherClosedError(RuntimeError):
+    """批处理器已关闭 (插件停止) 时，尚未完成的相关性判断以此异常结束"""
+
+
+class _RelevanceBatcher:
+    """在短时间窗口内合并多条相关性判断请求，通过一次 SLM 调用完成判断"""
+
+    __slots__ = (
+        "_text_chat",
+        "_text_chat_batch",
+        "_build_context",
+        "_question",
+        "_batch_size",
+        "_max_wait",
+        "_merge",
+        "_queue",
+        "_worker",
+        "_dispatching",
+        "_closed",
+    )
+
+    def __init__(
+        self,
+        provider,
+        system_prompt: str,
+        batch_system_prompt: str,
+        build_context: Callable[[Sequence[Tuple[str, str]], Tuple[str, str]], str],
+        question: str,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        max_wait_ms: int = DEFAULT_BATCH_MAX_WAIT_MS,
+        mode: str = BATCH_MODE_MERGE,
+    ):
+        # 系统提示词固定不变，预先绑定到 text_chat 上
+        self._text_chat = functools.partial(provider.text_chat, system_prompt=system_prompt)
+        self._text_chat_batch = functools.partial(provider.text_chat, system_prompt=batch_system_prompt)
+        # 上下文 (历史 + 最新消息) 与提问分开保存：单条判断时拼接提问，批量判断时只引用上下文
+        self._build_context = build_context
+        self._question = question
+        self._batch_size = max(1, batch_size)
+        self._max_wait = max(0, max_wait_ms) / 1000
+        self._merge = mode != BATCH_MODE_CONCURRENT
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._worker: Optional[asyncio.Task] = None
+        self._dispatching: Set[asyncio.Task] = set()
+        self._closed = False
+
+    async def submit(self, history_messages: Sequence[Tuple[str, str]], latest_message: Tuple[str, str]) -> str:
+        if self._closed:
+            raise _BatcherClosedError()
+        # 入队时即生成上下文，保证使用的是消息到达时的历史
+        context = self._build_context(history_messages, latest_message)
+
+        if self._batch_size == 1:
+            # 不合并时直接调用 SLM，省去队列、工作任务和 future 的开销
+            judgment = await self._judge_single(context)
+            if self._closed:
+                raise _BatcherClosedError()
+            return judgment
+
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((context, future))
+        return await future
+
+    async def close(self):
+        self._closed = True
+        if self._worker:
+            self._worker.cancel()
+            self._worker = None
+        for task in list(self._dispatching):
+            task.cancel()
+        while not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(_BatcherClosedError())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = []
+            try:
+                batch.append(await self._queue.get())
+                deadline = loop.time() + self._max_wait
+                while len(batch) < self._batch_size:
+                    if not self._queue.empty():
+                        batch.append(self._queue.get_nowait())
+                        continue
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout=timeout))
+                    except asyncio.TimeoutError:
+                        break
+            except asyncio.CancelledError:
+                # 已出队但尚未派发的请求不再会被处理，结束其 future 以免等待方永久挂起
+                self._fail_pending(batch)
+                raise
+
+            task = asyncio.create_task(self._dispatch(batch))
+            self._dispatching.add(task)
+            task.add_done_callback(self._dispatching.discard)
+
+    async def _dispatch(self, batch: List[Tuple[str, asyncio.Future]]):
+        contexts = [context for context, _ in batch]
+        try:
+            if len(contexts) == 1:
+                judgments = [await self._judge_single(contexts[0])]
+            elif self._merge:
+                judgments = await self._judge_batch(contexts)
+            else:
+                judgments = await self._judge_each(contexts)
+        except asyncio.CancelledError:
+            self._fail_pending(batch)
+            raise
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), judgment in zip(batch, judgments):
+            if not future.done():
+                future.set_result(judgment)
+
+    @staticmethod
+    def _fail_pending(batch: List[Tuple[str, asyncio.Future]]):
+        # 工作任务只会被 close() 取消，等待方收到 _BatcherClosedError 而不是 CancelledError
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(_BatcherClosedError())
+
+    async def _judge_single(self, context: str) -> str:
+        prompt = f"{context}\n{self._question}"
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("发送给 SLM 的 Prompt:\n%s", prompt)
+
+        slm_response = await self._text_chat(prompt=prompt)
+        completion_text = slm_response.completion_text if slm_response and slm_response.completion_text else ""
+
+        # 只看回复开头的几个字符，部分 SLM 会在 yes/no 之后附带解释
+        head = completion_text.lstrip()[:3].lower()
+        if head == "yes":
+            return "yes"
+        return "no" if head.startswith("no") else head
+
+    async def _judge_batch(self, contexts: List[str]) -> List[str]:
+        batch_prompt_parts = [f"Item {i}:\n{context}" for i, context in enumerate(contexts, 1)]
+        batch_prompt_parts.append(BATCH_PROMPT_SUFFIX.format(count=len(contexts)))
+        batch_prompt = "\n\n".join(batch_prompt_parts)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("发送给 SLM 的批量 Prompt (%d 条):\n%s", len(contexts), batch_prompt)
+
+        slm_response = await self._text_chat_batch(prompt=batch_prompt)
+        completion_text = slm_response.completion_text if slm_response and slm_response.completion_text else ""
+
+        judgments = self._parse_batch_judgments(completion_text, len(contexts))
+        if judgments is None:
+            logger.warning("无法解析 SLM 的批量判断结果，回退为逐条判断。SLM 回复: '%s'", completion_text)
+            judgments = await self._judge_each(contexts)
+
+        return judgments
+
+    async def _judge_each(self, contexts: List[str]) -> List[str]:
+        return list(await asyncio.gather(*(self._judge_single(context) for context in contexts)))
+
+    @staticmethod
+    def _parse_batch_judgments(completion_text: str, count: int) -> Optional[List[str]]:
+        start, end = completion_text.find("["), completion_text.rfind("]")
+        if start == -1 or end < start:
+            return None
+
+        try:
+            values = json.loads(completion_text[start : end + 1])
+        except json.JSONDecodeError:
+            return None
+
+        if not isinstance(values, list) or len(values) != count:
+            return None
+
+        judgments = [str(value).strip().lower() for value in values]
+        if any(judgment not in ("yes", "no") for judgment in judgments):
+            return None
+
+        return judgments
 
 
 @register(
-    "astrbot_plugin_smart_listener",
+    PLUGIN_NAME,
     "Smart Listener",
     "智能监听白名单群组消息 (Bot 消息加入历史, 兼容指令, SLM Prompt 优化)",
     "1.4.0",
     "https://github.com/MagicFoxDemon/astrbot_plugin_smart-listener",
 )
 class SmartListenerPlugin(Star):
+    # 每条消息都会读取的属性放入 slots；Star 基类未声明 __slots__，实例仍保留 __dict__ 供框架使用
+    __slots__ = (
+        "config",
+        "context",
+        "enabled",
+        "relevance_checker_provider_id",
+        "relevance_checker_system_prompt",
+        "group_whitelist",
+        "_group_whitelist_int",
+        "character_name",
+        "relevance_batch_size",
+        "relevance_batch_max_wait_ms",
+        "relevance_batch_mode",
+        "speculative_conversation_fetch",
+        "semantic_cache_enabled",
+        "persist_history",
+        "_user_prefix",
+        "_bot_prefix",
+        "_slm_prompt_suffix",
+        "_message_history",
+        "_history_log",
+        "_relevance_checker_provider",
+        "_provider_retry_at",
+        "_relevance_batcher",
+        "_last_err_logged",
+        "_inflight_judgments",
+        "_verdict_cache",
+    )
+
     def __init__(self, context: Context, config: AstrBotConfig):
         super().__init__(context)
         self.config = config
@@ -38,29 +534,72 @@ class SmartListenerPlugin(Star):
 
         self.enabled: bool = self.config.get("enabled", True)
         self.relevance_checker_provider_id: str = self.config.get("relevance_checker_provider_id", "")
-        self.relevance_checker_system_prompt: str = self.config.get(
-            "relevance_checker_system_prompt",
-            "You are an assistant that analyzes chat history. Given a sequence of messages, determine if the LAST message is relevant to the character '{character}', considering the preceding messages as context. Reply ONLY with 'yes' if it is relevant, and 'no' if it is not.".format(character=self.config.get("character", "Bot")),
-        )
-        self.group_whitelist: List[str] = [str(g) for g in self.config.get("group_whitelist", [])]
+        raw_group_whitelist = self.config.get("group_whitelist", [])
+        self.group_whitelist: FrozenSet[str] = frozenset(str(g) for g in raw_group_whitelist)
+        # 平台适配器给出整数群号时直接用整数集合判断，免去每条消息的 str() 转换
+        # 只收录与字符串形式完全一致的条目 (排除 "0123" 等)，保证两种判断结果相同
+        group_whitelist_int = set()
+        for g in raw_group_whitelist:
+            try:
+                group_id_int = int(g)
+            except (TypeError, ValueError):
+                continue
+            if str(group_id_int) == str(g):
+                group_whitelist_int.add(group_id_int)
+        self._group_whitelist_int: FrozenSet[int] = frozenset(group_whitelist_int)
 
         # 读取配置文件中的 character 值，默认为 "Bot"
         self.character_name: str = self.config.get("character", "Bot")
 
-        self._message_history: Dict[str, deque] = {}
-        self._relevance_checker_provider = None
+        # 系统提示词中的 {character} 占位符在加载配置时一次性替换，包括用户自定义的提示词
+        raw_system_prompt: str = self.config.get(
+            "relevance_checker_system_prompt",
+            "You are an assistant that analyzes chat history. Given a sequence of messages, determine if the LAST message is relevant to the character '{character}', considering the preceding messages as context. Reply ONLY with 'yes' if it is relevant, and 'no' if it is not.",
+        )
+        # 只替换 {character}，提示词中的其他花括号 (如 JSON 示例) 保持原样
+        self.relevance_checker_system_prompt: str = raw_system_prompt.replace("{character}", self.character_name)
+
+        # 历史消息中的发送者只有 "user" 和角色名两种，预先生成 Prompt 中使用的 "标签: " 前缀
+        self._user_prefix: str = "User: "
+        self._bot_prefix: str = f"{self.character_name.capitalize()}: "
+        self._slm_prompt_suffix: str = (
+            f"\nConsidering the chat history above, is the LAST message relevant to the character '{self.character_name}'? Reply ONLY with 'yes' or 'no'."
+        )
+
+        self.relevance_batch_size: int = self.config.get("relevance_batch_size", DEFAULT_BATCH_SIZE)
+        self.relevance_batch_max_wait_ms: int = self.config.get("relevance_batch_max_wait_ms", DEFAULT_BATCH_MAX_WAIT_MS)
+        self.relevance_batch_mode: str = self.config.get("relevance_batch_mode", BATCH_MODE_MERGE)
+        self.speculative_conversation_fetch: bool = self.config.get("speculative_conversation_fetch", False)
+        self.semantic_cache_enabled: bool = self.config.get("semantic_cache_enabled", False)
+        self.persist_history: bool = self.config.get("persist_history", False)
+
+        self._message_history: DefaultDict[str, deque] = defaultdict(_make_history_deque)
+        self._history_log: Optional[_HistoryLog] = None
+        if self.persist_history:
+            self._load_history_log()
+        self._relevance_checker_provider = _UNSET
+        self._provider_retry_at = 0.0
+        self._relevance_batcher: Optional[_RelevanceBatcher] = None
+        self._last_err_logged: Dict[str, float] = {}
+        self._inflight_judgments: Dict[Tuple[str, str], asyncio.Future] = {}
+        self._verdict_cache: Optional[_VerdictCache] = None
+        if self.semantic_cache_enabled:
+            self._verdict_cache = _VerdictCache(
+                self.config.get("semantic_cache_model", DEFAULT_SEMANTIC_CACHE_MODEL),
+                self.config.get("semantic_cache_threshold", DEFAULT_SEMANTIC_CACHE_THRESHOLD),
+            )
 
         logger.info("智能监听插件初始化完成！状态: {}".format("启用" if self.enabled else "禁用"))
         if self.enabled:
             logger.info(f"相关性判断 LLM 供应商 ID: '{self.relevance_checker_provider_id}'")
             logger.info(f"已配置的角色名: '{self.character_name}'")
-            logger.info(f"已配置的群组白名单: {self.group_whitelist}")
+            logger.info(f"已配置的群组白名单: {sorted(self.group_whitelist)}")
             logger.info(f"历史消息队列长度: {MESSAGE_HISTORY_LENGTH}")
+            logger.info(
+                f"相关性判断批处理: 最多 {self.relevance_batch_size} 条 / 等待 {self.relevance_batch_max_wait_ms} ms / 模式 {self.relevance_batch_mode}"
+            )
 
     def _get_relevance_checker_provider(self):
-        if self._relevance_checker_provider:
-            return self._relevance_checker_provider
-
         provider = None
         if self.relevance_checker_provider_id:
             provider = self.context.get_provider_by_id(self.relevance_checker_provider_id)
@@ -72,6 +611,19 @@ class SmartListenerPlugin(Star):
             logger.warning("配置文件未指定 SLM 供应商 ID (relevance_checker_provider_id)。智能监听功能将无法正常工作。")
 
         self._relevance_checker_provider = provider
+        if not provider:
+            self._provider_retry_at = time.monotonic() + PROVIDER_RETRY_INTERVAL
+        else:
+            self._relevance_batcher = _RelevanceBatcher(
+                provider,
+                self.relevance_checker_system_prompt,
+                BATCH_SYSTEM_PROMPT.format(character=self.character_name, criteria=self.relevance_checker_system_prompt),
+                self._build_slm_context,
+                self._slm_prompt_suffix,
+                batch_size=self.relevance_batch_size,
+                max_wait_ms=self.relevance_batch_max_wait_ms,
+                mode=self.relevance_batch_mode,
+            )
         return provider
 
     @filter.event_message_type(filter.EventMessageType.GROUP_MESSAGE)
@@ -85,23 +637,35 @@ class SmartListenerPlugin(Star):
             logger.error("收到了群聊消息但 group_id 为 None，可能是平台适配器问题。忽略此消息。")
             return
 
-        if str(group_id) not in self.group_whitelist:
+        if not self._is_whitelisted(group_id):
             return
+        group_id = str(group_id)
 
+        # 纯媒体消息的文本为空，先判断文本再获取发送者 ID，可省去两次适配器调用
         message_text = event.get_message_str()
-        sender_id = event.get_sender_id()
-        self_id = event.get_self_id()
+        if not message_text:
+            return
+
+        if event.get_sender_id() == event.get_self_id():
+            return
 
-        if not message_text or sender_id == self_id:
+        is_at_command = event.is_at_or_wake_command
+        # 插件加载时供应商可能尚未初始化，因此在首条消息时才查找，之后直接读取缓存的结果；
+        # 未找到时不会永久放弃，每隔 PROVIDER_RETRY_INTERVAL 秒重新查找一次
+        slm_provider = self._relevance_checker_provider
+        if slm_provider is _UNSET or (slm_provider is None and time.monotonic() >= self._provider_retry_at):
+            slm_provider = self._get_relevance_checker_provider()
+
+        # 无法进行相关性判断时，只有 @ 消息仍需加入历史，其余消息直接忽略
+        if not slm_provider and not is_at_command:
             return
 
-        cleaned_message_text = MESSAGE_PREFIX_PATTERN.sub("", message_text, count=1)
+        cleaned_message_text = _strip_prefix(message_text)
         if not cleaned_message_text:
             logger.debug("清理后消息文本为空，忽略。")
             return
-        logger.debug(f"原始消息文本: '{message_text}' -> 清理后用于历史/LLM 的文本: '{cleaned_message_text}'")
-
-        is_at_command = event.is_at_or_wake_command
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("原始消息文本: '%s' -> 清理后用于历史/LLM 的文本: '%s'", message_text, cleaned_message_text)
 
         sender = "user"
         self._add_message_to_history(group_id, (sender, cleaned_message_text))
@@ -109,84 +673,162 @@ class SmartListenerPlugin(Star):
         if is_at_command:
             return
 
-        slm_provider = self._get_relevance_checker_provider()
-
-        if not slm_provider:
+        if _is_obviously_irrelevant(cleaned_message_text):
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("消息 '%s' 无需 SLM 判断，视为无关。", cleaned_message_text)
             return
 
+        conversation_task: Optional[asyncio.Task] = None
         try:
             history_messages = self._get_history_messages(group_id)
-            slm_prompt = self._build_slm_prompt(history_messages, (sender, cleaned_message_text))
-
-            logger.debug(f"发送给 SLM 的 Prompt:\n{slm_prompt}")
-
-            slm_response = await slm_provider.text_chat(
-                prompt=slm_prompt,
-                system_prompt=self.relevance_checker_system_prompt,
-            )
 
-            relevance_judgment = (
-                slm_response.completion_text.strip().lower() if slm_response and slm_response.completion_text else ""
-            )
+            # 在等待 SLM 判断的同时预先获取会话，判断为 "no" 时丢弃
+            if self.speculative_conversation_fetch:
+                conversation_task = asyncio.create_task(
+                    self._fetch_conversation(event.unified_msg_origin, group_id)
+                )
 
-            logger.debug(f"SLM 对最新消息 '{cleaned_message_text}' 的判断结果: '{relevance_judgment}'")
+            # 同一群组中相同内容的消息正在判断时，直接等待其结果，不再重复调用 SLM
+            inflight_key = (group_id, cleaned_message_text)
+            inflight_judgment = self._inflight_judgments.get(inflight_key)
+            if inflight_judgment:
+                # 等待期间可能有新消息加入历史，自行判断时需使用消息到达时的历史
+                history_snapshot = tuple(history_messages)
+                try:
+                    relevance_judgment = await asyncio.shield(inflight_judgment)
+                except asyncio.CancelledError:
+                    # 发起判断的消息处理被取消时共享结果也随之取消，此时自行判断；自身被取消则照常向上传递
+                    current_task = asyncio.current_task()
+                    if not inflight_judgment.cancelled() or getattr(current_task, "cancelling", lambda: 0)():
+                        raise
+                    relevance_judgment = await self._judge_relevance(
+                        group_id, history_snapshot, (sender, cleaned_message_text)
+                    )
+            else:
+                inflight_judgment = asyncio.get_running_loop().create_future()
+                self._inflight_judgments[inflight_key] = inflight_judgment
+                try:
+                    relevance_judgment = await self._judge_relevance(
+                        group_id, history_messages, (sender, cleaned_message_text)
+                    )
+                    inflight_judgment.set_result(relevance_judgment)
+                except Exception as e:
+                    inflight_judgment.set_exception(e)
+                    # 可能没有其他消息在等待该结果，标记异常已被取走以免产生警告
+                    inflight_judgment.exception()
+                    raise
+                finally:
+                    if not inflight_judgment.done():
+                        inflight_judgment.cancel()
+                    del self._inflight_judgments[inflight_key]
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("SLM 对最新消息 '%s' 的判断结果: '%s'", cleaned_message_text, relevance_judgment)
 
             if relevance_judgment == "yes":
-                logger.info(f"SLM 判断最新消息 '{cleaned_message_text}' 与 Bot 有关，在白名单群组 {group_id} 触发主 LLM 回复。")
-
-                umo = event.unified_msg_origin
-                curr_cid = await self.context.conversation_manager.get_curr_conversation_id(umo)
-
-                session_id_to_use = curr_cid
-                conversation = None
-                contexts = []
-
-                if curr_cid:
-                    conversation = await self.context.conversation_manager.get_conversation(umo, curr_cid)
-                    if conversation:
-                        try:
-                            contexts = json.loads(conversation.history)
-                        except json.JSONDecodeError:
-                            logger.error(f"解析当前活跃会话 {curr_cid} 的历史记录失败。")
-                            contexts = []
-                    else:
-                        logger.warning(f"找到当前活跃会话 ID {curr_cid} 但无法获取会话对象。将尝试使用 ID 进行回复。")
-                        pass
-                else:
-                    session_id_to_use = str(group_id)
-                    logger.debug(f"当前 Origin {umo} 无活跃会话，使用群组 ID {group_id} 作为会话 ID {session_id_to_use}。")
-
-                    fallback_conversation = await self.context.conversation_manager.get_conversation(
-                        umo, session_id_to_use
-                    )
+                logger.info("SLM 判断最新消息 '%s' 与 Bot 有关，在白名单群组 %s 触发主 LLM 回复。", cleaned_message_text, group_id)
 
-                    if fallback_conversation:
-                        conversation = fallback_conversation
-                        try:
-                            contexts = json.loads(conversation.history)
-                        except json.JSONDecodeError:
-                            logger.error(f"解析 fallback 会话 {session_id_to_use} 的历史记录失败。")
-                            contexts = []
-                    else:
-                        logger.debug(f"Fallback 会话 ID {session_id_to_use} 不存在现有会话，将尝试创建新会话。")
-                        pass
+                if conversation_task:
+                    session_id_to_use, conversation = await conversation_task
+                    conversation_task = None
+                else:
+                    session_id_to_use, conversation = await self._fetch_conversation(event.unified_msg_origin, group_id)
 
+                # 只传入 conversation，由 AstrBot 在处理 LLM 请求时自行从 conversation.history 加载上下文，
+                # 无需在此解析历史 JSON（同时传入非空 contexts 时 conversation 会被忽略）
                 yield event.request_llm(
                     prompt=cleaned_message_text,
                     session_id=session_id_to_use,
-                    contexts=contexts,
                     conversation=conversation,
                 )
 
                 event.stop_event()
                 logger.info("已触发主 LLM 回复并停止事件传播。")
 
+        except _BatcherClosedError:
+            logger.debug("插件正在停止，放弃对消息 '%s' 的相关性判断。", cleaned_message_text)
+        except Exception as e:
+            error_type = type(e).__name__
+            now = time.monotonic()
+            if now - self._last_err_logged.get(error_type, float("-inf")) > ERROR_TRACEBACK_INTERVAL:
+                self._last_err_logged[error_type] = now
+                logger.error(
+                    "处理消息 '%s' 过程中发生异常 (SLM 判断或触发主 LLM): %s: %s",
+                    cleaned_message_text,
+                    error_type,
+                    e,
+                    exc_info=True,
+                )
             else:
-                pass
+                logger.error(
+                    "处理消息 '%s' 过程中发生异常 (SLM 判断或触发主 LLM): %s: %s", cleaned_message_text, error_type, e
+                )
+        finally:
+            if conversation_task:
+                _discard_task(conversation_task)
+
+    async def _judge_relevance(
+        self, group_id: str, history_messages: Sequence[Tuple[str, str]], latest_message: Tuple[str, str]
+    ) -> str:
+        verdict_cache = self._verdict_cache
+        if not verdict_cache:
+            return await self._submit_relevance(history_messages, latest_message)
+
+        # 计算句向量期间可能有新消息加入历史，先固定当前的历史
+        history_messages = tuple(history_messages)
+        # 缓存只按最新消息本身匹配，不考虑上下文：Bot 参与了近期对话时同样的话可能是在回应 Bot，不使用缓存
+        character_name = self.character_name
+        if any(sender == character_name for sender, _ in history_messages):
+            return await self._submit_relevance(history_messages, latest_message)
+
+        latest_msg = latest_message[1]
+        embedding = await verdict_cache.embed(latest_msg)
+        if embedding is not None:
+            cached_judgment = verdict_cache.lookup(group_id, embedding)
+            if cached_judgment:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("最新消息 '%s' 命中语义缓存，复用判断结果。", latest_msg)
+                return cached_judgment
+
+        relevance_judgment = await self._submit_relevance(history_messages, latest_message)
+        # 只缓存 "no"：误命中最多漏掉一次回复，而复用 "yes" 会让 Bot 在无关的场合主动回复
+        if embedding is not None and relevance_judgment == "no":
+            verdict_cache.store(group_id, embedding, relevance_judgment)
+        return relevance_judgment
+
+    async def _submit_relevance(
+        self, history_messages: Sequence[Tuple[str, str]], latest_message: Tuple[str, str]
+    ) -> str:
+        # 等待期间 terminate() 可能已关闭并移除批处理器
+        relevance_batcher = self._relevance_batcher
+        if relevance_batcher is None:
+            raise _BatcherClosedError()
+        return await relevance_batcher.submit(history_messages, latest_message)
+
+    def _is_whitelisted(self, group_id) -> bool:
+        if isinstance(group_id, int):
+            return group_id in self._group_whitelist_int
+        return str(group_id) in self.group_whitelist
+
+    async def _fetch_conversation(self, umo: str, group_id: str) -> Tuple[str, Optional[Conversation]]:
+        curr_cid = await self.context.conversation_manager.get_curr_conversation_id(umo)
+
+        session_id_to_use = curr_cid
+        conversation = None
+
+        if curr_cid:
+            conversation = await self.context.conversation_manager.get_conversation(umo, curr_cid)
+            if not conversation:
+                logger.warning("找到当前活跃会话 ID %s 但无法获取会话对象。将尝试使用 ID 进行回复。", curr_cid)
+        else:
+            session_id_to_use = group_id
+            logger.debug("当前 Origin %s 无活跃会话，使用群组 ID %s 作为会话 ID %s。", umo, group_id, session_id_to_use)
 
-        except Exception as e:
-            logger.error(f"处理消息 '{cleaned_message_text}' 过程中发生异常 (SLM 判断或触发主 LLM): {str(e)}", exc_info=True)
-            pass
+            conversation = await self.context.conversation_manager.get_conversation(umo, session_id_to_use)
+            if not conversation:
+                logger.debug("Fallback 会话 ID %s 不存在现有会话，将尝试创建新会话。", session_id_to_use)
+
+        return session_id_to_use, conversation
 
     @filter.on_decorating_result()
     async def on_message_decorated(self, event: AstrMessageEvent):
@@ -204,40 +846,45 @@ class SmartListenerPlugin(Star):
         elif hasattr(event, "group_id"):
             group_id = event.group_id
         else:
-            logger.debug(f"无法获取事件的 group_id，事件类型: {type(event)}，忽略此消息。")
+            logger.debug("无法获取事件的 group_id，事件类型: %s，忽略此消息。", type(event))
             return
 
         if not group_id:
-            logger.error(f"无法获取事件的 group_id，事件类型: {type(event)}。忽略此消息。")
+            logger.error("无法获取事件的 group_id，事件类型: %s。忽略此消息。", type(event))
             return
 
-        if str(group_id) not in self.group_whitelist:
+        if not self._is_whitelisted(group_id):
             return
+        group_id = str(group_id)
 
         result = event.get_result()
 
         if not result or not result.chain:
             return
 
-        bot_message_text = self._extract_text_from_message_chain(result.chain)
+        # 一次遍历同时完成前缀清理和 Bot 消息文本的拼接；前缀只可能出现在第一个非空的 Plain 组件中
+        text_parts = []
+        for component in result.chain:
+            if isinstance(component, Plain):
+                text = component.text
+                if not text_parts and text:
+                    cleaned_text = _strip_prefix(text)
+                    if cleaned_text is not text:
+                        component.text = text = cleaned_text
+                if text:
+                    text_parts.append(text)
+
+        cleaned_bot_message_text = "".join(text_parts)
 
-        if not bot_message_text:
+        if not cleaned_bot_message_text:
             logger.debug("Bot 发送的消息为空，忽略。")
             return
 
-        cleaned_bot_message_text = MESSAGE_PREFIX_PATTERN.sub("", bot_message_text, count=1)
-
         sender = self.character_name
         self._add_message_to_history(group_id, (sender, cleaned_bot_message_text))
 
-        logger.debug(f"Bot 消息已加入群组 {group_id} 的历史队列。消息内容: '{cleaned_bot_message_text}'")
-
-        for component in result.chain:
-            if isinstance(component, Plain):
-                original_text = component.text
-                cleaned_text = MESSAGE_PREFIX_PATTERN.sub("", original_text, count=1)
-                if original_text != cleaned_text:
-                    component.text = cleaned_text
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Bot 消息已加入群组 %s 的历史队列。消息内容: '%s'", group_id, cleaned_bot_message_text)
 
     def _add_message_to_history(self, group_id: str, message: Tuple[str, str]):
         sender, message_text = message
@@ -245,44 +892,86 @@ class SmartListenerPlugin(Star):
             logger.warning("尝试添加到历史的消息文本为空，忽略。")
             return
 
-        if group_id not in self._message_history:
-            self._message_history[group_id] = deque(maxlen=MESSAGE_HISTORY_LENGTH)
-
         self._message_history[group_id].append(message)
 
-    def _get_history_messages(self, group_id: str) -> List[Tuple[str, str]]:
-        if group_id not in self._message_history:
-            return []
+        if self._history_log:
+            try:
+                self._history_log.append(group_id, message)
+            except OSError as e:
+                logger.warning(f"写入历史消息日志失败，已停止持久化历史消息: {str(e)}")
+                self._history_log.close()
+                self._history_log = None
+
+    def _load_history_log(self):
+        if StarTools is None:
+            logger.warning("当前 AstrBot 版本不支持获取插件数据目录，本次运行不持久化历史消息。")
+            return
 
-        return list(self._message_history[group_id])
+        history_log = None
+        try:
+            history_log = _HistoryLog(os.path.join(str(StarTools.get_data_dir(PLUGIN_NAME)), HISTORY_LOG_FILENAME))
+            self._message_history = history_log.load(self.group_whitelist)
+        except (OSError, RuntimeError) as e:
+            logger.warning(f"读取历史消息日志失败，本次运行不持久化历史消息: {str(e)}")
+            if history_log:
+                history_log.close()
+            return
 
-    def _build_slm_prompt(self, history_messages: List[Tuple[str, str]], latest_message: Tuple[str, str]) -> str:
-        slm_prompt_parts = ["Chat History:"]
-        if not history_messages:
-            slm_prompt_parts.append("None (This is the start of a new potential conversation thread).")
+        self._history_log = history_log
+        logger.info(f"已从历史消息日志恢复 {len(self._message_history)} 个群组的历史消息。")
+
+    def _get_history_messages(self, group_id: str) -> Sequence[Tuple[str, str]]:
+        # 直接返回历史队列本身，Prompt 在入队时同步生成，无需复制
+        return self._message_history.get(group_id, ())
+
+    def _build_slm_context(self, history_messages: Sequence[Tuple[str, str]], latest_message: Tuple[str, str]) -> str:
+        user_prefix, bot_prefix = self._user_prefix, self._bot_prefix
+
+        # SLM 的延迟主要取决于 Prompt 的长度：截断过长的消息，历史总长度超出上限时从最早的消息开始丢弃
+        history_entries = []
+        history_chars = 0
+        for sender, msg in reversed(history_messages):
+            entry = (user_prefix if sender == "user" else bot_prefix) + _truncate_message(msg)
+            history_chars += len(entry)
+            if history_entries and history_chars > SLM_PROMPT_HISTORY_MAX_CHARS:
+                break
+            history_entries.append(entry)
+
+        if history_entries:
+            history_lines = [
+                index_prefix + entry for index_prefix, entry in zip(_HISTORY_INDEX_PREFIXES, reversed(history_entries))
+            ]
         else:
-            for i, (sender, msg) in enumerate(history_messages):
-                slm_prompt_parts.append(f"{i + 1}. {sender.capitalize()}: {msg}")
+            history_lines = SLM_PROMPT_EMPTY_HISTORY
 
         latest_sender, latest_msg = latest_message
-        slm_prompt_parts.append(f"\nLatest Message: {latest_sender.capitalize()}: {latest_msg}")
-        slm_prompt_parts.append(
-            "\nConsidering the chat history above, is the LAST message relevant to the character '{character}'? Reply ONLY with 'yes' or 'no'.".format(character=self.character_name)
-        )
-
-        return "\n".join(slm_prompt_parts)
+        latest_prefix = user_prefix if latest_sender == "user" else bot_prefix
 
-    def _extract_text_from_message_chain(self, message_chain: List) -> str:
-        text = ""
-        for component in message_chain:
-            if isinstance(component, Plain):
-                text += component.text
-        return text
+        return "\n".join(
+            (
+                SLM_PROMPT_HEADER,
+                *history_lines,
+                _format_slm_prompt_latest((latest_prefix, _truncate_message(latest_msg))),
+            )
+        )
 
     async def terminate(self):
         logger.info("智能监听插件正在停止...")
-        self._relevance_checker_provider = None
+        if self._relevance_batcher:
+            await self._relevance_batcher.close()
+            self._relevance_batcher = None
+        self._relevance_checker_provider = _UNSET
+        if self._history_log:
+            # 历史队列清空前压缩一次日志，下次加载时无需读取已失效的记录
+            try:
+                self._history_log.compact()
+            except OSError as e:
+                logger.warning(f"压缩历史消息日志失败: {str(e)}")
+            self._history_log.close()
+            self._history_log = None
         self._message_history.clear()
+        if self._verdict_cache:
+            self._verdict_cache.clear()
         logger.info("智能监听插件已停止，历史消息队列已清空。")
         pass
 